@@ -16,6 +16,10 @@ def get_args():
     parser.add_argument('--learning-rate', type=int, default=0.0001, help="(default: 0.0001)")
     parser.add_argument('--pretrained', type=bool, default=False, help="(default: False)")
     parser.add_argument('--translate', type=bool, default=False, help="(default: False)")
+    parser.add_argument('--compile', type=bool, default=False, help="torch.compile the model for training, (default: False)")
+    parser.add_argument('--amp', type=bool, default=False, help="run the forward pass under bf16 autocast, (default: False)")
+    parser.add_argument('--quantize', type=bool, default=False, help="int8 dynamic quantization for translation, (default: False)")
+    parser.add_argument('--script', type=bool, default=False, help="TorchScript the model for translation, (default: False)")
 
     args = parser.parse_args()
 
@@ -2,9 +2,10 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 
 import os
-import numpy as np
 
 from config import get_args
 from preprocess import load_data_loader
@@ -14,18 +15,14 @@ use_cuda = torch.cuda.is_available()
 device = torch.device('cuda' if use_cuda else 'cpu')
 
 
-def masking(source, target, args):
-    source_mask = (source != 1).unsqueeze(-2)
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
 
-    target_mask = (target != 1).unsqueeze(-2)
-    sentence_len = target.size(1)
 
-    numpy_mask = torch.tril(torch.ones((1, sentence_len, sentence_len)))
-    numpy_mask = (numpy_mask == 0).to(device)
-
-    target_mask = target_mask & numpy_mask
-
-    return source_mask, target_mask
+def checkpoint_filename(args):
+    # v2: fused attention projections, the 'layers' ModuleList and the non persistent positional encoding
+    # changed the state_dict keys, checkpoints of the previous layout (best_model_*) cannot be loaded into this model
+    return 'best_model_v2_' + str(args.max_len) + '_' + str(args.heads) + '_' + str(args.embedding_dim) + '_' + str(args.n) + '_ckpt.t7'
 
 
 def save_model(model, epoch, args):
@@ -37,8 +34,7 @@ def save_model(model, epoch, args):
     if not os.path.isdir('checkpoints'):
         os.mkdir('checkpoints')
 
-    filename = 'best_model_' + str(args.max_len) + '_' + str(args.heads) + '_' + str(args.embedding_dim) + '_' + str(args.n) + '_ckpt.t7'
-    torch.save(state, './checkpoints/' + filename)
+    torch.save(state, './checkpoints/' + checkpoint_filename(args))
 
 
 def train(train_loader, model, optimizer, criterion, args):
@@ -47,43 +43,51 @@ def train(train_loader, model, optimizer, criterion, args):
     train_loss = 0.0
     for i, batch_data in enumerate(train_loader):
         source, target = batch_data.source.transpose(0, 1).to(device), batch_data.target.transpose(0, 1).to(device)
-        source_mask, target_mask = masking(source, target[:, :-1], args)
 
-        output = model(source, source_mask, target[:, :-1], target_mask)
-        ys = target[:, 1:].contiguous().view(-1)
+        # bf16 has the fp32 exponent range, so no GradScaler is needed
+        with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=args.amp):
+            output = model(source, target[:, :-1])
+            ys = target[:, 1:].contiguous().view(-1)
+
+            loss = F.cross_entropy(output.view(-1, output.size(-1)), ys, ignore_index=1)
 
         optimizer.zero_grad()
-        loss = F.cross_entropy(output.view(-1, output.size(-1)), ys, ignore_index=1)
         train_loss += loss.data
         loss.backward()
         optimizer.step()
-        if i % args.print_interval == 0:
+        if i % args.print_interval == 0 and is_main_process():
             print("Training loss: ", loss.data)
     return train_loss / float(len(train_loader))
 
 
-def translate(model, test_loader, target_vocab, args):
+def translate(model, test_loader, target_vocab, args, device=device):
     model.eval()
+    # dynamic quantized Linear layers only take float32 inputs, bf16 activations from autocast would reach them
+    use_amp = args.amp and not args.quantize
 
     sentence_list = []
     with torch.no_grad():
         for i, batch_data in enumerate(test_loader):
             for source in batch_data.source.transpose(0, 1):
                 source = source.unsqueeze(0).to(device)
-                target = torch.ones((1, args.max_len), dtype=torch.int64).to(device)
-                target[:, 0] = 2
+                source_mask = model.make_source_mask(source)
+                with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_amp):
+                    encoder_out = model.encode(source, source_mask)
+                    cross_key_values = model.project_cross_key_values(encoder_out)
+
+                # start with <BOS>, then feed back only the newest word, the decoder caches the previous ones
+                target = torch.full((1, 1), 2, dtype=torch.int64, device=device)
+                key_values = None
 
                 sentence = ''
                 for pos in range(1, args.max_len):
-                    source_mask, target_mask = masking(source, target, args)
-                    output = F.softmax(model(source, source_mask, target, target_mask), dim=-1)
-                    _, target[:, pos] = output[:, pos].data.topk(1)
-
-                    if use_cuda:
-                        word = int(target[:, pos].data.cpu().numpy())
-                    else:
-                        word = int(target[:, pos].numpy())
-                    if word == 3:
+                    with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_amp):
+                        output, key_values = model.decode(encoder_out, target, source_mask, None, key_values, cross_key_values)
+                    target = output[:, -1].argmax(dim=-1, keepdim=True)
+
+                    word = target.item()
+                    # <EOS> ends the sentence, so does <pad>: cached decoding has no target mask to hide it afterwards
+                    if word == 3 or word == 1:
                         print("finished sentence")
                         break
                     sentence += target_vocab.itos[word] + ' '
@@ -92,18 +96,31 @@ def translate(model, test_loader, target_vocab, args):
 
 
 def main(args):
+    # Ampere and newer GPUs run fp32 matmuls/convolutions on tensor cores in TF32 (fp32 range, 10 bit mantissa)
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+
+    # training launched with torchrun, one process per GPU. Translation always runs in a single process.
+    local_rank = int(os.environ.get('LOCAL_RANK', -1))
+    if args.translate and int(os.environ.get('RANK', 0)) != 0:
+        return 0
+    if local_rank != -1 and not args.translate and not dist.is_initialized():
+        torch.cuda.set_device(local_rank)
+        dist.init_process_group(backend='nccl')
+
     if args.translate:
         test_loader, source, target = load_data_loader(args, mode='test')
         train_loader, source, target = load_data_loader(args, mode='train')
+    elif dist.is_initialized():
+        train_loader, source, target = load_data_loader(args, mode='train', rank=dist.get_rank(), world_size=dist.get_world_size())
     else:
         train_loader, source, target = load_data_loader(args, mode='train')
 
     if args.pretrained:
         print('Load pretrained model ...')
         model = Transformer(len(source.vocab), len(target.vocab), args.max_len, args.heads, args.embedding_dim, args.dropout_rate, args.n).to(device)
-        filename = 'best_model_' + str(args.max_len) + '_' + str(args.heads) + '_' + str(args.embedding_dim) + '_' + \
-                   str(args.n) + '_ckpt.t7'
-        checkpoint = torch.load('./checkpoints/' + filename)
+        checkpoint = torch.load('./checkpoints/' + checkpoint_filename(args), map_location=device)
         model.load_state_dict(checkpoint['model'])
         start_epoch = checkpoint['epoch']
     else:
@@ -111,16 +128,49 @@ def main(args):
         start_epoch = 1
 
     if args.translate:
-        translate(model, test_loader, target.vocab, args)
+        translate_device = device
+        if args.quantize:
+            # int8 weights with int32 accumulation for every nn.Linear (attention projections, feed forward, output),
+            # embeddings, LayerNorm and softmax stay in floating point. Dynamic quantization kernels run on CPU.
+            print('Quantize model ...')
+            model = torch.ao.quantization.quantize_dynamic(model.to('cpu'), {nn.Linear}, dtype=torch.qint8)
+            translate_device = torch.device('cpu')
+        if args.script:
+            # TorchScript removes the per layer Python dispatch, freezing inlines the weights as constants
+            # so the elementwise chains can be fused. The methods used by translate() must be preserved.
+            print('Script model ...')
+            model = torch.jit.freeze(torch.jit.script(model.eval()),
+                                     preserved_attrs=['make_source_mask', 'encode', 'project_cross_key_values', 'decode'])
+
+        translate(model, test_loader, target.vocab, args, translate_device)
         return 0
 
     optimizer = optim.Adam(model.parameters(), lr=args.learning_rate)
     criterion = nn.CrossEntropyLoss().to(device)
 
+    # the wrapped modules share their parameters with model, which is still used for saving checkpoints
+    train_model = model
+    if dist.is_initialized():
+        # gradients are all-reduced in 25MB buckets while the backward pass is still running,
+        # gradient_as_bucket_view lets .grad alias the buckets instead of being copied into them
+        train_model = DistributedDataParallel(train_model, device_ids=[torch.cuda.current_device()],
+                                              bucket_cap_mb=25, gradient_as_bucket_view=True)
+    if args.compile:
+        train_model = torch.compile(train_model, mode='max-autotune')
+
     for epoch in range(start_epoch, args.epochs + 1):
-        train_loss = train(train_loader, model, optimizer, criterion, args)
-        print("[Epoch: {0:4d}] training loss: {1:2.3f}".format(epoch, train_loss))
-        save_model(model, epoch, args)
+        train_loss = train(train_loader, train_model, optimizer, criterion, args)
+        if dist.is_initialized():
+            # mean over the ranks, each one only saw its own shard
+            dist.all_reduce(train_loss)
+            train_loss /= dist.get_world_size()
+
+        if is_main_process():
+            print("[Epoch: {0:4d}] training loss: {1:2.3f}".format(epoch, train_loss))
+            save_model(model, epoch, args)
+
+    if dist.is_initialized():
+        dist.destroy_process_group()
 
 
 if __name__ == "__main__":
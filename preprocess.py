@@ -61,17 +61,19 @@ def load_raw_data_to_csv(source_filename, target_filename, mode='train'):
     train_df.to_csv(mode + '.csv', index=False)
 
 
-def load_data_loader(args, mode='train'):
+def load_data_loader(args, mode='train', rank=0, world_size=1):
+    # one csv per rank, the processes of a distributed run share the working directory
+    csv_name = mode + '_' + str(rank) if world_size > 1 else mode
+
     if mode == 'train':
         train_dir_s = os.path.join(args.data_path, 'train/train.en')
         train_dir_t = os.path.join(args.data_path, 'train/train.de')
-        load_raw_data_to_csv(train_dir_s, train_dir_t, mode='train')
-        path = './train.csv'
+        load_raw_data_to_csv(train_dir_s, train_dir_t, mode=csv_name)
     elif mode == 'test':
         test_dir_s = os.path.join(args.data_path, 'test/test.en')
         test_dir_t = os.path.join(args.data_path, 'test/test.de')
-        load_raw_data_to_csv(test_dir_s, test_dir_t, mode='test')
-        path = './test.csv'
+        load_raw_data_to_csv(test_dir_s, test_dir_t, mode=csv_name)
+    path = './' + csv_name + '.csv'
 
     source, target = create_fields(args)
 
@@ -81,6 +83,16 @@ def load_data_loader(args, mode='train'):
         fields=[('source', source), ('target', target)]
     )
 
+    # the vocabulary is built on the full dataset so every rank maps words to the same indices
+    source.build_vocab(data)
+    target.build_vocab(data)
+
+    # distributed training, each rank iterates over its own 1 / world_size of the sentences.
+    # The shards must have the same size, a rank with one batch more would hang in DDP's all-reduce.
+    if world_size > 1:
+        shard_len = len(data.examples) // world_size
+        data.examples = data.examples[:shard_len * world_size][rank::world_size]
+
     data_loader = BucketIterator(
         data,
         batch_size=args.batch_size,
@@ -88,13 +100,8 @@ def load_data_loader(args, mode='train'):
         shuffle=True
     )
 
-    source.build_vocab(data)
-    target.build_vocab(data)
-
-    if os.path.isfile('train.csv'):
-        os.remove('train.csv')
-    if os.path.isfile('test.csv'):
-        os.remove('test.csv')
+    if os.path.isfile(path):
+        os.remove(path)
 
     return data_loader, source, target
 
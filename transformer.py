@@ -1,7 +1,10 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
 
 import math
+from typing import List, Optional, Tuple
 
 from config import get_args
 
@@ -12,67 +15,177 @@ from config import get_args
 class PositionalEncoding(nn.Module):
     def __init__(self, embedding_dim, sentence_len=128):
         super(PositionalEncoding, self).__init__()
-        self.positionalEncoding = torch.zeros((sentence_len, embedding_dim))
+        position = torch.arange(sentence_len, dtype=torch.float).unsqueeze(1)
+        div_term = torch.exp(torch.arange(0, embedding_dim, 2, dtype=torch.float) * -(math.log(10000.0) / embedding_dim))
 
-        for pos in range(0, sentence_len):
-            for i in range(0, embedding_dim // 2):
-                self.positionalEncoding[pos, 2 * i] = math.sin(pos / math.pow(10000, 2 * i / embedding_dim))
-                self.positionalEncoding[pos, 2 * i + 1] = math.cos(pos / math.pow(10000, 2 * i / embedding_dim))
+        positional_encoding = torch.zeros((sentence_len, embedding_dim))
+        positional_encoding[:, 0::2] = torch.sin(position * div_term)
+        # an odd embedding_dim has one cos column less than sin columns, the last column stays 0
+        positional_encoding[:, 1::2] = torch.cos(position * div_term[:embedding_dim // 2])
 
-        self.register_buffer('positional_encoding', self.positionalEncoding)
+        # derived from the shapes only, no need to store it in checkpoints
+        self.register_buffer('positional_encoding', positional_encoding, persistent=False)
 
-    def forward(self, x):
+    def forward(self, x: Tensor, offset: int = 0) -> Tensor:
+        # offset is the position of the first word of x, non zero when decoding with a cache
         sentence_len = x.size(1)
-        out = x + self.positionalEncoding[:sentence_len, :].to(x)
+        # match the activation dtype so autocast (fp16/bf16) does not upcast the sum to fp32
+        out = x + self.positional_encoding[offset:offset + sentence_len].to(x.dtype)
         return out
 
 
-class ScaledDotProductAttention(nn.Module):
-    def __init__(self, dk):
-        super(ScaledDotProductAttention, self).__init__()
-        self.dk = dk
-        self.softmax = nn.Softmax(dim=-1)
+def sdpa_uses_fused_kernel(query: Tensor, key: Tensor, value: Tensor, mask: Optional[Tensor], dropout_p: float) -> bool:
+    # Whether F.scaled_dot_product_attention runs a fused kernel for these inputs, (batch, head, len, dk).
+    # A backend being enabled is not enough, e.g. flash attention does not take an attn_mask.
+    if query.is_cuda:
+        try:
+            params = torch.backends.cuda.SDPAParams(query, key, value, mask, dropout_p, False, False)
+        except TypeError:
+            # torch < 2.5, SDPAParams has no enable_gqa argument
+            params = torch.backends.cuda.SDPAParams(query, key, value, mask, dropout_p, False)
+        return torch.backends.cuda.can_use_flash_attention(params) or torch.backends.cuda.can_use_efficient_attention(params)
 
-    def forward(self, query, key, value, mask):
-        out = torch.matmul(query, key.transpose(2, 3))
-        out /= math.sqrt(self.dk)
+    # there is also a CPU flash attention kernel, ask the dispatcher which kernel SDPA picks
+    return torch._fused_sdp_choice(query, key, value, mask, dropout_p, False) != int(torch.backends.cuda.SDPBackend.MATH)
 
-        if mask is not None:
-            mask = mask.unsqueeze(1)
-            out = out.masked_fill(mask == 0, -1e10)
-        out = self.softmax(out)
 
-        out = torch.matmul(out, value)
+def fused_attention_applies(query: Tensor, key: Tensor, value: Tensor, mask: Optional[Tensor], dropout_p: float) -> bool:
+    if torch.jit.is_scripting():
+        # the backend selection cannot be queried from TorchScript, assume the fused kernels on CUDA only
+        return query.is_cuda
+    else:
+        return sdpa_uses_fused_kernel(query, key, value, mask, dropout_p)
 
-        return out
+
+def expand_mask_dims(mask: Tensor) -> Tensor:
+    # a 2-D (query, key) or 3-D mask broadcasts from the left, as in F.scaled_dot_product_attention
+    while mask.dim() < 4:
+        mask = mask.unsqueeze(0)
+    return mask
+
+
+class ScaledDotProductAttention(nn.Module):
+    def __init__(self, dk, dropout_rate=0.0, max_chunk_size_mb=1024):
+        super(ScaledDotProductAttention, self).__init__()
+        self.dk = dk
+        self.scale = dk ** -0.5
+        self.dropout_rate = float(dropout_rate)
+        self.max_chunk_size_mb = max_chunk_size_mb
+
+    def chunked_attention(self, query: Tensor, key: Tensor, value: Tensor, mask: Optional[Tensor], chunk_len: int) -> Tensor:
+        # Plain PyTorch attention over blocks of chunk_len queries,
+        # only a (batch, head, chunk_len, key_len) slice of the attention matrix is alive at a time.
+
+        # scaling the (len, dk) query instead of the (len, len) scores touches len / dk times fewer elements
+        query = query * self.scale
+
+        outs: List[Tensor] = []
+        for start in range(0, query.size(1), chunk_len):
+            # einsum batches over (batch, head) directly on the (batch, len, head, dk) layout, no transposed copies
+            out = torch.einsum('blhd,bshd->bhls', [query[:, start:start + chunk_len], key])
+
+            if mask is not None:
+                mask_chunk = expand_mask_dims(mask)
+                if mask_chunk.size(2) != 1:
+                    mask_chunk = mask_chunk[:, :, start:start + chunk_len]
+                # large negative but finite in fp16/bf16 too, so a fully masked row does not turn into NaN
+                out = out.masked_fill(~mask_chunk, -1e4)
+            out = F.softmax(out, dim=-1)
+            out = F.dropout(out, p=self.dropout_rate, training=self.training)
+
+            outs.append(torch.einsum('bhls,bshd->blhd', [out, value]))
+
+        return torch.cat(outs, dim=1)
+
+    def forward(self, query: Tensor, key: Tensor, value: Tensor, mask: Optional[Tensor]) -> Tensor:
+        # query, key, value are (batch, len, head, dk) and the output has the same layout.
+        # mask is boolean and broadcastable to (batch, head, query_len, key_len), 2-D and 3-D masks included.
+        # True means "attend", which is the convention of F.scaled_dot_product_attention.
+        batch, query_len, head, _ = query.size()
+        key_len = key.size(1)
+
+        dropout_p = self.dropout_rate if self.training else 0.0
+        # SDPA takes (batch, head, len, dk), the transposes are strided views
+        query_t, key_t, value_t = query.transpose(1, 2), key.transpose(1, 2), value.transpose(1, 2)
+
+        # When no fused kernel applies to these inputs SDPA runs its math kernel, which materializes the whole
+        # attention matrix. Past max_chunk_size_mb compute it block by block instead.
+        # Under autocast the softmax keeps the scores in fp32, so they take at least 4 bytes per element.
+        row_size = batch * head * key_len * max(query.element_size(), 4)
+        if row_size * query_len > self.max_chunk_size_mb * 1024 * 1024 and \
+                not fused_attention_applies(query_t, key_t, value_t, mask, dropout_p):
+            chunk_len = max(1, self.max_chunk_size_mb * 1024 * 1024 // row_size)
+            return self.chunked_attention(query, key, value, mask, chunk_len)
+
+        # The fused kernels (FlashAttention / memory-efficient) never materialize the (L, L) attention matrix.
+        # They return an output whose transpose back is already contiguous, the math kernel returns a contiguous
+        # (batch, head, len, dk) tensor and the reshape in MultiHeadAttention then copies it.
+        out = F.scaled_dot_product_attention(
+            query_t, key_t, value_t,
+            attn_mask=mask,
+            dropout_p=dropout_p
+        )
+
+        return out.transpose(1, 2)
 
 
 class MultiHeadAttention(nn.Module):
-    def __init__(self, head, embedding_dim, dropout_rate):
+    def __init__(self, head, embedding_dim, dropout_rate, self_attention=True):
         super(MultiHeadAttention, self).__init__()
         self.embedding_dim = embedding_dim
         self.head = head
         self.dk = embedding_dim // head
 
-        self.dense_query = nn.Linear(embedding_dim, embedding_dim)
-        self.dense_key = nn.Linear(embedding_dim, embedding_dim)
-        self.dense_value = nn.Linear(embedding_dim, embedding_dim)
+        # Self attention projects query, key and value from the same input, so one (D, 3D) GEMM replaces three.
+        # Cross attention projects the query from the decoder and key/value from the encoder output.
+        if self_attention:
+            self.dense_qkv = nn.Linear(embedding_dim, 3 * embedding_dim)
+            self.dense_query = None
+            self.dense_key_value = None
+        else:
+            self.dense_qkv = None
+            self.dense_query = nn.Linear(embedding_dim, embedding_dim)
+            self.dense_key_value = nn.Linear(embedding_dim, 2 * embedding_dim)
 
-        self.scaled_dot_product_attention = ScaledDotProductAttention(dk=self.dk)
+        self.scaled_dot_product_attention = ScaledDotProductAttention(dk=self.dk, dropout_rate=dropout_rate)
 
         self.dense = nn.Linear(embedding_dim, embedding_dim)
 
-    def forward(self, query, key, value, mask=None):
+    def project_key_value(self, key: Tensor) -> Tuple[Tensor, Tensor]:
+        # cross attention only, the encoder output is fixed while decoding so this can be computed once
+        batch = key.size(0)
+        key_out, value_out = self.dense_key_value(key).view(batch, -1, 2, self.head, self.dk).unbind(dim=2)
+
+        return key_out, value_out
+
+    def forward(self, query: Tensor, key: Tensor, value: Tensor, mask: Optional[Tensor] = None,
+                past_key_value: Optional[Tuple[Tensor, Tensor]] = None) -> Tuple[Tensor, Tuple[Tensor, Tensor]]:
+        # Self attention: past_key_value is the (key, value) of the previous words,
+        # the new words are projected and appended to it.
+        # Cross attention: past_key_value is the output of project_key_value, key and value are not projected again.
+        # Returns (out, (key, value)) so it can be cached.
         batch, _, embedding_dim = query.size()
 
-        query_out = self.dense_query(query).view(batch, -1, self.head, self.dk).transpose(1, 2)
-        key_out = self.dense_key(key).view(batch, -1, self.head, self.dk).transpose(1, 2)
-        value_out = self.dense_value(value).view(batch, -1, self.head, self.dk).transpose(1, 2)
+        # Splitting heads only produces strided views of the projection output, (batch, len, head, dk),
+        # no transpose is needed before or after attention.
+        if self.dense_qkv is not None:
+            query_out, key_out, value_out = self.dense_qkv(query).view(batch, -1, 3, self.head, self.dk).unbind(dim=2)
+
+            if past_key_value is not None:
+                key_out = torch.cat([past_key_value[0], key_out], dim=1)
+                value_out = torch.cat([past_key_value[1], value_out], dim=1)
+        else:
+            query_out = self.dense_query(query).view(batch, -1, self.head, self.dk)
 
-        out = self.scaled_dot_product_attention(query_out, key_out, value_out, mask).transpose(1, 2).contiguous().view(batch, -1, self.embedding_dim)
+            if past_key_value is not None:
+                key_out, value_out = past_key_value
+            else:
+                key_out, value_out = self.project_key_value(key)
+
+        out = self.scaled_dot_product_attention(query_out, key_out, value_out, mask).reshape(batch, -1, self.embedding_dim)
         out = self.dense(out)
-        
-        return out
+
+        return out, (key_out, value_out)
 
 
 class LayerNorm(nn.Module):
@@ -84,11 +197,9 @@ class LayerNorm(nn.Module):
         self.gamma = nn.Parameter(torch.ones(self.embedding_dim), requires_grad=True)
         self.beta = nn.Parameter(torch.zeros(self.embedding_dim), requires_grad=True)
 
-    def forward(self, x):
-        mean = x.mean(dim=-1, keepdim=True)
-        std = x.std(dim=-1, keepdim=True)
-
-        norm = self.gamma * (x - mean) / (std + self.eps) + self.beta
+    def forward(self, x: Tensor) -> Tensor:
+        # single fused kernel, normalizes with sqrt(var + eps) (biased variance) as in the paper
+        norm = F.layer_norm(x, [self.embedding_dim], self.gamma, self.beta, self.eps)
 
         return norm
 
@@ -99,23 +210,14 @@ class FeedForward(nn.Module):
         self.embedding_dim = embedding_dim
         self.inner_dim = 2048
 
-        # in the paper, they suggest two kind of methods.
         self.dense = nn.Sequential(
             nn.Linear(self.embedding_dim, self.inner_dim),
-            nn.ReLU(),
+            nn.GELU(),
             nn.Dropout(dropout_rate),
             nn.Linear(self.inner_dim, self.embedding_dim)
         )
 
-        # If you use Conv layer, you have to adjust the dimension.
-        # self.conv = nn.Sequential(
-        #     nn.Conv2d(self.embedding_dim, self.inner_dim, kernel_size=1),
-        #     nn.ReLU(),
-        #     nn.Dropout(dropout_rate),
-        #     nn.Conv2d(self.inner_dim, self.embedding_dim, kernel_size=1)
-        # )
-
-    def forward(self, x):
+    def forward(self, x: Tensor) -> Tensor:
         out = self.dense(x)
         return out
 
@@ -136,10 +238,10 @@ class EncoderLayer(nn.Module):
         self.dropout1 = nn.Dropout(dropout_rate)
         self.dropout2 = nn.Dropout(dropout_rate)
 
-    def forward(self, x, x_mask):
+    def forward(self, x: Tensor, x_mask: Optional[Tensor]) -> Tensor:
         # multi head attention
-        multi_head_out = self.dropout1(self.multi_head_attention(x, x, x, x_mask))
-        multi_head_out = self.layer_norm1(multi_head_out + x)
+        multi_head_out, _ = self.multi_head_attention(x, x, x, x_mask)
+        multi_head_out = self.layer_norm1(self.dropout1(multi_head_out) + x)
 
         # feed forward layer
         feed_forward_out = self.dropout2(self.feed_forward(multi_head_out))
@@ -148,7 +250,7 @@ class EncoderLayer(nn.Module):
 
 
 class Encoder(nn.Module):
-    def __init__(self, input_size, max_len, heads, embedding_dim, dropout_rate, N):
+    def __init__(self, input_size, max_len, heads, embedding_dim, dropout_rate, N, positional_encoding=None):
         super(Encoder, self).__init__()
         self.input_size = input_size
         self.max_len = max_len
@@ -158,20 +260,22 @@ class Encoder(nn.Module):
         # Embedding shape, (max_num of inputs(voca_size), embedding_dim)
         self.embedding = nn.Embedding(input_size, embedding_dim)
 
-        # PositionalEncoding
-        self.positionalEncoding = PositionalEncoding(embedding_dim)
+        # PositionalEncoding, the table can be shared with the decoder
+        if positional_encoding is None:
+            positional_encoding = PositionalEncoding(embedding_dim, max_len)
+        self.positionalEncoding = positional_encoding
 
         for _ in range(N):
             encoderLayers.append(EncoderLayer(heads, embedding_dim, dropout_rate))
-        self.encoder = nn.Sequential(*encoderLayers)
+        self.layers = nn.ModuleList(encoderLayers)
 
-    def forward(self, x, x_mask):
+    def forward(self, x: Tensor, x_mask: Optional[Tensor]) -> Tensor:
         embedding_out = self.embedding(x)
-        out = embedding_out + self.positionalEncoding(embedding_out)
+        out = self.positionalEncoding(embedding_out)
 
         # N time iteration
-        for _ in range(self.N):
-            out = self.encoder[_](out, x_mask)
+        for layer in self.layers:
+            out = layer(out, x_mask)
         return out
 
 
@@ -180,7 +284,7 @@ class DecoderLayer(nn.Module):
         super(DecoderLayer, self).__init__()
 
         self.multi_head_attention1 = MultiHeadAttention(heads, embedding_dim, dropout_rate)
-        self.multi_head_attention2 = MultiHeadAttention(heads, embedding_dim, dropout_rate)
+        self.multi_head_attention2 = MultiHeadAttention(heads, embedding_dim, dropout_rate, self_attention=False)
 
         self.layer_norm1 = LayerNorm(embedding_dim)
         self.layer_norm2 = LayerNorm(embedding_dim)
@@ -192,84 +296,161 @@ class DecoderLayer(nn.Module):
         self.feed_forward = FeedForward(embedding_dim, dropout_rate)
         self.dropout3 = nn.Dropout(dropout_rate)
 
-    def forward(self, encoder_out, target, x_mask, target_mask):
-        # multi head attention
-        multi_head_out1 = self.dropout1(self.multi_head_attention1(target, target, target, target_mask))
-        out = self.layer_norm1(multi_head_out1 + target)
+    def project_cross_key_value(self, encoder_out: Tensor) -> Tuple[Tensor, Tensor]:
+        return self.multi_head_attention2.project_key_value(encoder_out)
 
-        # multi head attention
-        multi_head_out2 = self.dropout2(self.multi_head_attention2(out, encoder_out, encoder_out, x_mask))
-        out = self.layer_norm2(multi_head_out2 + out)
+    def forward(self, encoder_out: Tensor, target: Tensor, x_mask: Optional[Tensor], target_mask: Optional[Tensor],
+                past_key_value: Optional[Tuple[Tensor, Tensor]] = None,
+                cross_key_value: Optional[Tuple[Tensor, Tensor]] = None) -> Tuple[Tensor, Tuple[Tensor, Tensor]]:
+        # multi head attention, only the new words are projected when past_key_value is given
+        multi_head_out, present_key_value = self.multi_head_attention1(target, target, target, target_mask, past_key_value)
+        out = self.layer_norm1(self.dropout1(multi_head_out) + target)
+
+        # multi head attention, reuses the encoder key/value projection when cross_key_value is given
+        multi_head_out, _ = self.multi_head_attention2(out, encoder_out, encoder_out, x_mask, cross_key_value)
+        out = self.layer_norm2(self.dropout2(multi_head_out) + out)
 
         # feed forward layer
         feed_forward_out = self.dropout3(self.feed_forward(out))
         out = self.layer_norm3(feed_forward_out + out)
 
-        return out
+        return out, present_key_value
 
 
 class Decoder(nn.Module):
-    def __init__(self, input_size, max_len, head, embedding_dim, dropout_rate, N):
+    def __init__(self, input_size, max_len, head, embedding_dim, dropout_rate, N, positional_encoding=None):
         super(Decoder, self).__init__()
         self.N = N
         decoderLayers = []
 
         self.embedding = nn.Embedding(input_size, embedding_dim)
-        self.positionalEncoding = PositionalEncoding(embedding_dim)
+        if positional_encoding is None:
+            positional_encoding = PositionalEncoding(embedding_dim, max_len)
+        self.positionalEncoding = positional_encoding
 
         for _ in range(N):
             decoderLayers.append(DecoderLayer(head, embedding_dim, dropout_rate))
 
-        self.decoder = nn.Sequential(*decoderLayers)
+        self.layers = nn.ModuleList(decoderLayers)
+
+    def project_cross_key_values(self, encoder_out: Tensor) -> List[Tuple[Tensor, Tensor]]:
+        cross_key_values: List[Tuple[Tensor, Tensor]] = []
+        for layer in self.layers:
+            cross_key_values.append(layer.project_cross_key_value(encoder_out))
+        return cross_key_values
+
+    def forward(self, encoder_out: Tensor, x: Tensor, x_mask: Optional[Tensor], target_mask: Optional[Tensor],
+                past_key_values: Optional[List[Tuple[Tensor, Tensor]]] = None,
+                cross_key_values: Optional[List[Tuple[Tensor, Tensor]]] = None) -> Tuple[Tensor, List[Tuple[Tensor, Tensor]]]:
+        # past_key_values holds one self attention (key, value) cache per layer, x is then only the new words.
+        # cross_key_values holds the per layer output of project_cross_key_values.
+        offset = 0
+        if past_key_values is not None:
+            offset = past_key_values[0][0].size(1)
 
-    def forward(self, encoder_out, x, x_mask, target_mask):
         embedding_out = self.embedding(x)
-        out = embedding_out + self.positionalEncoding(embedding_out)
+        out = self.positionalEncoding(embedding_out, offset)
 
-        for _ in range(self.N):
-            out = self.decoder[_](encoder_out, out, x_mask, target_mask)
-        return out
+        present_key_values: List[Tuple[Tensor, Tensor]] = []
+        for i, layer in enumerate(self.layers):
+            past_key_value: Optional[Tuple[Tensor, Tensor]] = None
+            if past_key_values is not None:
+                past_key_value = past_key_values[i]
+            cross_key_value: Optional[Tuple[Tensor, Tensor]] = None
+            if cross_key_values is not None:
+                cross_key_value = cross_key_values[i]
+            out, present_key_value = layer(encoder_out, out, x_mask, target_mask, past_key_value, cross_key_value)
+            present_key_values.append(present_key_value)
+        return out, present_key_values
 
 
 class Transformer(nn.Module):
-    def __init__(self, input_vocab, target_vocab, max_len, heads, embedding_dim, dropout_rate, N):
+    def __init__(self, input_vocab, target_vocab, max_len, heads, embedding_dim, dropout_rate, N, pad_idx=1):
         super(Transformer, self).__init__()
-        self.encoder = Encoder(input_vocab, max_len, heads, embedding_dim, dropout_rate, N)
-        self.decoder = Decoder(target_vocab, max_len, heads, embedding_dim, dropout_rate, N)
+        self.pad_idx = pad_idx
+
+        # one positional encoding table for both the encoder and the decoder
+        self.positionalEncoding = PositionalEncoding(embedding_dim, max_len)
+
+        self.encoder = Encoder(input_vocab, max_len, heads, embedding_dim, dropout_rate, N, self.positionalEncoding)
+        self.decoder = Decoder(target_vocab, max_len, heads, embedding_dim, dropout_rate, N, self.positionalEncoding)
 
         self.out = nn.Sequential(
             nn.Linear(embedding_dim, target_vocab),
         )
 
-    def forward(self, x, x_mask, target, target_mask):
-        encoder_out = self.encoder(x, x_mask)
-        decoder_out = self.decoder(encoder_out, target, x_mask, target_mask)
+    @torch.jit.export
+    def make_source_mask(self, x: Tensor) -> Tensor:
+        # (batch, 1, 1, source_len), hides <pad> keys
+        return (x != self.pad_idx).unsqueeze(1).unsqueeze(2)
+
+    def make_target_mask(self, target: Tensor) -> Tensor:
+        # (batch, 1, target_len, target_len), hides <pad> keys and the future words
+        sentence_len = target.size(1)
+        subsequent_mask = torch.tril(torch.ones((sentence_len, sentence_len), dtype=torch.bool, device=target.device))
+
+        return self.make_source_mask(target) & subsequent_mask
+
+    def forward(self, x: Tensor, target: Tensor, x_mask: Optional[Tensor] = None, target_mask: Optional[Tensor] = None) -> Tensor:
+        # the masks are built once here and shared by every layer and head
+        if x_mask is None:
+            x_mask = self.make_source_mask(x)
+        if target_mask is None:
+            target_mask = self.make_target_mask(target)
+
+        encoder_out = self.encode(x, x_mask)
+        out, _ = self.decode(encoder_out, target, x_mask, target_mask)
 
-        out = self.out(decoder_out)
         return out
 
+    # encode / project_cross_key_values / decode are exported so translation also works with a TorchScript model
+    @torch.jit.export
+    def encode(self, x: Tensor, x_mask: Optional[Tensor]) -> Tensor:
+        return self.encoder(x, x_mask)
+
+    @torch.jit.export
+    def project_cross_key_values(self, encoder_out: Tensor) -> List[Tuple[Tensor, Tensor]]:
+        return self.decoder.project_cross_key_values(encoder_out)
+
+    @torch.jit.export
+    def decode(self, encoder_out: Tensor, target: Tensor, x_mask: Optional[Tensor], target_mask: Optional[Tensor] = None,
+               past_key_values: Optional[List[Tuple[Tensor, Tensor]]] = None,
+               cross_key_values: Optional[List[Tuple[Tensor, Tensor]]] = None) -> Tuple[Tensor, List[Tuple[Tensor, Tensor]]]:
+        # For autoregressive decoding, feed the returned key_values back with only the newest word as target,
+        # each step then projects one word instead of the whole prefix.
+        # target_mask can be None in that case since the newest word may attend to every cached word.
+        # cross_key_values from project_cross_key_values(encoder_out) skips projecting the encoder output every step.
+        decoder_out, key_values = self.decoder(encoder_out, target, x_mask, target_mask, past_key_values, cross_key_values)
 
-# Test Code
-# def masking(source, target, args):
-#     source_mask = (source != 1).unsqueeze(-2)
-#
-#     target_mask = (target != 1).unsqueeze(-2)
-#     sentence_len = target.size(1)
-#
-#     numpy_mask = torch.tril(torch.ones((1, sentence_len, sentence_len)))
-#     numpy_mask = (numpy_mask == 0).to('cpu')
-#
-#     target_mask = target_mask & numpy_mask
-#
-#     return source_mask, target_mask
-#
-#
-# args = get_args()
-# source = torch.randint(high=100, size=(4, args.max_len))
-# target = torch.randint(high=50, size=(4, args.max_len))
-# target_input = target[:, :-1]
-#
-# source_mask, target_mask = masking(source, target_input, args)
-#
-# transformer = Transformer(100, 50, args.max_len, heads=4, embedding_dim=512, dropout_rate=0.1, N=6)
-# print(transformer(source, source_mask, target_input, target_mask).shape)
+        out = self.out(decoder_out)
+        return out, key_values
+
+
+# Test Code, python transformer.py
+if __name__ == "__main__":
+    args = get_args()
+    # no <pad> (1) in the inputs, cached decoding does not mask it
+    source = torch.randint(low=2, high=100, size=(4, args.max_len))
+    target = torch.randint(low=2, high=50, size=(4, args.max_len))
+    target_input = target[:, :-1]
+
+    transformer = Transformer(100, 50, args.max_len, heads=4, embedding_dim=512, dropout_rate=0.1, N=6).eval()
+    with torch.no_grad():
+        full_out = transformer(source, target_input)
+        print(full_out.shape)
+
+        # decoding one word at a time with the caches has to match the full forward pass on the same prefix
+        source_mask = transformer.make_source_mask(source)
+        encoder_out = transformer.encode(source, source_mask)
+        cross_key_values = transformer.project_cross_key_values(encoder_out)
+
+        key_values = None
+        step_outs = []
+        for pos in range(target_input.size(1)):
+            out, key_values = transformer.decode(encoder_out, target_input[:, pos:pos + 1], source_mask, None,
+                                                 key_values, cross_key_values)
+            step_outs.append(out)
+
+        cached_out = torch.cat(step_outs, dim=1)
+        assert torch.allclose(cached_out, full_out, atol=1e-4), (cached_out - full_out).abs().max()
+        print('cached decoding matches forward')